@@ -15,8 +15,30 @@
 # In[ ]:
 
 
-get_ipython().run_cell_magic('bash', '', 'CYEAR=`date +"%Y"`\nDEST=./990data/raw/\nfor y in $(seq 2015 $CYEAR); do\n    PART=1\n    COMPLETE=0\n    until [ $COMPLETE -eq 1 ]; do\n        URL="https://apps.irs.gov/pub/epostcard/990/xml/${y}/download990xml_${y}_${PART}.zip"\n        wget -q -N $URL -P $DEST\n        if head $DEST/download990xml_${y}_${PART}.zip | grep -q html; then\n            COMPLETE=1\n            rm -f $DEST/download990xml_${y}_${PART}.zip\n        else\n            echo "Updating/Downloading $URL"\n        fi\n        ((PART++))\n    done\ndone\n')
-
+# runs only in the notebook; as a script (and in the script's pool workers, which
+# re-import it under the spawn/forkserver start methods) use scripts/download_raw990s.sh
+try:
+    get_ipython().run_cell_magic('bash', '', '''
+CYEAR=`date +"%Y"`
+DEST=./990data/raw/
+for y in $(seq 2015 $CYEAR); do
+    PART=1
+    COMPLETE=0
+    until [ $COMPLETE -eq 1 ]; do
+        URL="https://apps.irs.gov/pub/epostcard/990/xml/${y}/download990xml_${y}_${PART}.zip"
+        wget -q -N $URL -P $DEST
+        if head $DEST/download990xml_${y}_${PART}.zip | grep -q html; then
+            COMPLETE=1
+            rm -f $DEST/download990xml_${y}_${PART}.zip
+        else
+            echo "Updating/Downloading $URL"
+        fi
+        ((PART++))
+    done
+done
+''')
+except NameError:
+    pass
 
 # ## Data ETL
 # 
@@ -28,28 +50,51 @@ get_ipython().run_cell_magic('bash', '', 'CYEAR=`date +"%Y"`\nDEST=./990data/raw
 # The process is somewhat monolithic:
 # - rebuilds the entire lake from scratch
 # - handles all data formats, one at a time
+# 
+# `scripts/xml_extraction.py` is exported from this notebook; edit the code here and re-export it with
+# `jupyter nbconvert --to script xml_extraction.ipynb --output-dir scripts`
 
-# In[4]:
+# In[ ]:
 
 
 from pathlib import Path
+from contextlib import contextmanager
+from operator import itemgetter
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import os
+import collections
+import itertools
+import queue
+import threading
+import io
+import shutil
+import tempfile
+import time
+import re
 import zipfile
-import xml.etree.ElementTree as ET
-import pandas as pd
+from lxml import etree as ET
 import csv
-import json
+import orjson
 
 # ----------------- Logging ----------------------------------------------
+
+# import logging
+# logger = logging.getLogger()
+# fhandler = logging.FileHandler(filename='test_log.log', mode='a')
+# logger.addHandler(fhandler)
+# logger.setLevel(logging.INFO)
+# logging.debug("test")
+
 import logging
-logger = logging.getLogger()
-fhandler = logging.FileHandler(filename='test_log.log', mode='a')
-logger.addHandler(fhandler)
-logger.setLevel(logging.INFO)
-logging.debug("test")
+import datetime
+#logging.basicConfig(filename='test_log.log', encoding='utf-8', mode='w', level=logging.DEBUG, force=True, format='%{message}s')
+logging.basicConfig(filename='test_log.log', level=logging.DEBUG, force=True, format='%(levelname)s:%(message)s')
 
 # -------------- Constants / Environment Vars-----------------------------
-# Namespace for XML parsing
-ns = {'':'http://www.irs.gov/efile'}
+# Namespace for XML parsing: as a tag prefix ('{...}EIN') and as the e: prefix of XPaths
+NS = '{http://www.irs.gov/efile}'
+xpns = {'e':'http://www.irs.gov/efile'}
 
 # Locations of the data directories
 data_dir = Path('./990data')
@@ -58,20 +103,53 @@ json_dir = data_dir / 'json'
 csv_dir = data_dir / 'csv'
 tmp_dir = data_dir / 'tmp'
 
+# Return types to extract, e.g. {'990'}; None extracts every return type.
+# Returns of other types are skipped without being parsed.
+RETURN_TYPES = None
+
+# Compression for the exported zipfiles. Set to zipfile.ZIP_ZSTANDARD (Python
+# 3.14+) for faster exports at a similar ratio, but only if everything that
+# reads them can handle it: unzip, most OS archive tools and older Pythons can't
+ZIP_COMPRESSION = zipfile.ZIP_DEFLATED
+
+# Characters of officers.csv/grants.csv held in memory while a part is
+# exported, before spilling to a temp file
+SPOOL_SIZE = 256 * 1024 * 1024
+
+# Columns of the csv exports, in order
+RETURN_COLS = ['src_fname','return_type','ein','business_name','business_address',
+               'preparer_firm','preparer_address','tax_year']
+OFFICER_COLS = ['name','title','address','src_fname']
+GRANT_COLS = ['recipient_name','recipient_address','purpose','amount','src_fname']
+
 # -------------------- Utilities -----------------------------------------
 
-def safe_text(elements):
+# Text extraction is split by what the call site holds, so there's no type
+# check per call: a (possibly missing) element goes through elem_text, and the
+# text nodes selected by an XPath are simply ' '.join-ed.
+
+def elem_text(elem):
     
-    '''A text extraction utility for ElementTree(s)''' 
+    '''Text of a single (possibly missing) element'''
     
-    if elements is None:
-        return ''
-    elif type(elements) == ET.Element: 
-        # singular
-        return elements.text
-    else:
-        # plural
-        return ' '.join([e.text for e in elements]) 
+    return '' if elem is None else (elem.text or '')
+
+def xpath(path):
+    
+    '''Compiles an XPath expression (with the efile namespace as e:) once, for reuse'''
+    
+    return ET.XPath(path, namespaces=xpns, smart_strings=False)
+
+def first_text(elem,*xpaths):
+    
+    '''Text of the first of the XPaths that matches anything in elem, or None;
+    the rest are never evaluated'''
+    
+    for xp in xpaths:
+        texts = xp(elem)
+        if texts:
+            return ' '.join(texts)
+    return None
 
 def coalesce(*values):
     
@@ -80,200 +158,511 @@ def coalesce(*values):
     
     return next((v for v in values if v is not None and v != ''), None)
 
+def safe_int(text,fname,field):
+    
+    '''Converts text to an int, or None if it is missing or not a whole number;
+    text that is dropped that way is logged, naming the return and field'''
+    
+    if not text:
+        return None
+    try:
+        return int(text)
+    except ValueError:
+        logging.warning(f"{fname}: {field} {text!r} is not a whole number, exported as empty")
+        return None
+
 # ----------- XML Parser functions for various parts of the return --------------- 
-        
-def parse_return(root,fname):
+
+# Elements of interest. The return is streamed through a pull parser and each
+# of these is dispatched to its handler (see HANDLERS) as soon as it closes, so
+# the document is walked exactly once and never searched.
+
+def qualify(name):
+    
+    '''Namespace-qualifies an efile tag name, interned so the string is shared'''
+    
+    return sys.intern(NS + name)
+
+TAG_RETURN_TYPE_CD = qualify('ReturnTypeCd')
+TAG_RETURN_TYPE = qualify('ReturnType')
+TAG_TAX_YR = qualify('TaxYr')
+TAG_TAX_YEAR = qualify('TaxYear')
+TAG_FILER = qualify('Filer')
+TAG_PREPARER_FIRM_NAME = qualify('PreparerFirmName')
+TAG_PREPARER_FIRM_BUSINESS_NAME = qualify('PreparerFirmBusinessName')
+TAG_PREPARER_US_ADDRESS = qualify('PreparerUSAddress')
+TAG_PREPARER_FIRM_US_ADDRESS = qualify('PreparerFirmUSAddress')
+TAG_BUSINESS_OFFICER_GRP = qualify('BusinessOfficerGrp')
+TAG_OFFICER = qualify('Officer')
+TAG_RETURN_DATA = qualify('ReturnData')
+
+# header elements; only the first occurrence of each is kept
+HEADER_TAGS = (
+    TAG_RETURN_TYPE_CD, TAG_RETURN_TYPE, TAG_TAX_YR, TAG_TAX_YEAR, TAG_FILER,
+    TAG_PREPARER_FIRM_NAME, TAG_PREPARER_FIRM_BUSINESS_NAME,
+    TAG_PREPARER_US_ADDRESS, TAG_PREPARER_FIRM_US_ADDRESS,
+    TAG_BUSINESS_OFFICER_GRP, TAG_OFFICER
+)
+
+# officer groups, in any of the schema versions; officers are listed
+# grouped by tag, in this order
+OFFICER_TAGS = tuple(qualify(name) for name in (
+    'OfficerDirTrstKeyEmplGrp', 'OfficerDirectorTrusteeEmplGrp',
+    'OfcrDirTrusteesOrKeyEmployee', 'Form990PartVIISectionAGrp'
+))
+
+GRANT_TAGS = (qualify('GrantOrContributionPdDurYrGrp'),)
+
+# stand-in for missing header elements; every XPath on it comes up empty
+EMPTY = ET.Element('Empty')
+
+# compiled XPaths, relative to the element of interest; all select text nodes
+XP_EIN = xpath('e:EIN[1]/text()')
+XP_BUSINESS_NAME = xpath('(e:BusinessName/*)[1]/text()')
+XP_NAME_LINE = xpath('(e:Name/*)[1]/text()')
+XP_US_ADDRESS = xpath('e:USAddress/*/text()')
+XP_FIRST_CHILD = xpath('*[1]/text()')
+XP_CHILDREN = xpath('*/text()')
+
+XP_PERSON_NM = xpath('e:PersonNm[1]/text()')
+XP_PERSON_NAME = xpath('e:PersonName[1]/text()')
+XP_NAME = xpath('e:Name[1]/text()')
+XP_ANY_BUSINESS_NAME = xpath('.//e:BusinessName/*/text()')
+XP_ANY_US_ADDRESS = xpath('.//e:USAddress/*/text()')
+XP_TITLE_TXT = xpath('e:TitleTxt[1]/text()')
+XP_PERSON_TITLE_TXT = xpath('e:PersonTitleTxt[1]/text()')
+XP_TITLE = xpath('e:Title[1]/text()')
+
+XP_RECIPIENT_PERSON_NM = xpath('e:RecipientPersonNm[1]/text()')
+XP_RECIPIENT_BUSINESS_NAME = xpath('.//e:RecipientBusinessName/*/text()')
+XP_RECIPIENT_US_ADDRESS = xpath('.//e:RecipientUSAddress/*/text()')
+XP_PURPOSE = xpath('(.//e:GrantOrContributionPurposeTxt)[1]/text()')
+XP_AMT = xpath('e:Amt[1]/text()')
+
+def parse_return(header,fname):
     
     '''Packages an XML return's header data as a dictionary'''
     
     fields = {}
     
+    filer = header.get(TAG_FILER,EMPTY)
+    
     fields['src_fname'] = fname
     fields['return_type'] = coalesce(
-        safe_text(root.find('.//ReturnTypeCd',ns)),
-        safe_text(root.find('.//ReturnType',ns))
-    )
-    fields['ein'] = safe_text(root.find('.//Filer/EIN',ns))
-    fields['business_name'] = coalesce(
-        safe_text(root.find('.//Filer/BusinessName/*',ns)),
-        safe_text(root.find('.//Filer/Name/*',ns))
+        elem_text(header.get(TAG_RETURN_TYPE_CD)),
+        elem_text(header.get(TAG_RETURN_TYPE))
     )
-    fields['business_address'] = safe_text(root.findall('.//Filer/USAddress/*',ns))
-    fields['preparer_firm'] = coalesce(
-        safe_text(root.find('.//PreparerFirmName/*',ns)),
-        safe_text(root.find('.//PreparerFirmBusinessName/*',ns))
+    fields['ein'] = ' '.join(XP_EIN(filer))
+    fields['business_name'] = first_text(filer,XP_BUSINESS_NAME,XP_NAME_LINE)
+    fields['business_address'] = ' '.join(XP_US_ADDRESS(filer))
+    fields['preparer_firm'] = (
+        first_text(header.get(TAG_PREPARER_FIRM_NAME,EMPTY),XP_FIRST_CHILD) or
+        first_text(header.get(TAG_PREPARER_FIRM_BUSINESS_NAME,EMPTY),XP_FIRST_CHILD)
     )
-    fields['preparer_address'] = coalesce(
-        safe_text(root.findall('.//PreparerUSAddress/*',ns)),
-        safe_text(root.findall('.//PreparerFirmUSAddress/*',ns))
+    fields['preparer_address'] = (
+        first_text(header.get(TAG_PREPARER_US_ADDRESS,EMPTY),XP_CHILDREN) or
+        first_text(header.get(TAG_PREPARER_FIRM_US_ADDRESS,EMPTY),XP_CHILDREN)
     )
     
-    fields['tax_year']= coalesce(
-        safe_text(root.find('.//TaxYr',ns)), 
-        safe_text(root.find('.//TaxYear',ns))
-    )
+    fields['tax_year']= safe_int(coalesce(
+        elem_text(header.get(TAG_TAX_YR)), 
+        elem_text(header.get(TAG_TAX_YEAR))
+    ),fname,'tax_year')
     return fields
 
-def parse_officers(root,fname):
-    
-    '''Packages data about company officers as a list of dictionaries'''
-    
-    records = []
-    
-    # officers listed in data
-    officers = root.findall('.//OfficerDirTrstKeyEmplGrp',ns)
-    officers += root.findall('.//OfficerDirectorTrusteeEmplGrp',ns)
-    officers += root.findall('.//OfcrDirTrusteesOrKeyEmployee',ns)
-    officers += root.findall('.//Form990PartVIISectionAGrp',ns)
-    
-    for officer in officers:
-        fields = {
-            'name': coalesce(
-                safe_text(officer.find('PersonNm',ns)),
-                safe_text(officer.findall('.//BusinessName/*',ns)),
-                safe_text(officer.find('PersonName',ns))
-            ),
-            'title': coalesce(
-                safe_text(officer.find('TitleTxt',ns)),
-                safe_text(officer.find('Title',ns))
-            ),
-            'address': safe_text(officer.findall('.//USAddress/*',ns))
-        }
-        records += [fields]
+def parse_officer(officer):
     
-    # officer listed in header; only use if no other records found
-    if not records:
-        officer = root.find('.//BusinessOfficerGrp',ns)
-        
-        if officer == None:
-            officer = root.find('.//Officer',ns)
-            
-        fields = {
-            'name': coalesce(
-                safe_text(officer.find('PersonNm',ns)),
-                safe_text(officer.find('Name',ns))
-            ),
-            'title': coalesce(
-                safe_text(officer.find('PersonTitleTxt',ns)),
-                safe_text(officer.find('Title',ns))
-            ),
-            'address': ''
-        }
-        records += [fields]
-    
-    return records
-
-def parse_grants(root,fname):
-    
-    '''Packages data about grants and contributions as a list of dictionaries'''
-    
-    records = []
-    
-    grants = root.findall('.//GrantOrContributionPdDurYrGrp',ns)
-    for grant in grants:
-        fields = {
-            'recipient_name': coalesce(
-                safe_text(grant.find('RecipientPersonNm',ns)), 
-                safe_text(grant.findall('.//RecipientBusinessName/*',ns))
-            ),
-            'recipient_address': safe_text(grant.findall('.//RecipientUSAddress/*',ns)),
-            'purpose': safe_text(grant.find('.//GrantOrContributionPurposeTxt',ns)),
-            'amount': safe_text(grant.find('Amt',ns))
-        }
-        records += [fields]
-        
-    return records
+    '''Packages data about a company officer as a dictionary'''
+    
+    return {
+        'name': first_text(officer,XP_PERSON_NM,XP_ANY_BUSINESS_NAME,XP_PERSON_NAME),
+        'title': first_text(officer,XP_TITLE_TXT,XP_TITLE),
+        'address': ' '.join(XP_ANY_US_ADDRESS(officer))
+    }
 
+def parse_header_officer(header):
+    
+    '''Packages the officer listed in the header as a list of (at most one) dictionary'''
+    
+    officer = header.get(TAG_BUSINESS_OFFICER_GRP)
+    
+    if officer is None:
+        officer = header.get(TAG_OFFICER)
+    
+    if officer is None:
+        return []
+    
+    fields = {
+        'name': first_text(officer,XP_PERSON_NM,XP_NAME),
+        'title': first_text(officer,XP_PERSON_TITLE_TXT,XP_TITLE),
+        'address': ''
+    }
+    return [fields]
 
-def return_tree(root,fname): 
-    tree = parse_return(root,fname)
-    tree['officers'] = parse_officers(root,fname)
-    tree['grants'] = parse_grants(root,fname)
+def parse_grant(grant,fname):
     
-    return tree
+    '''Packages data about a grant or contribution as a dictionary'''
+    
+    return {
+        'recipient_name': first_text(grant,XP_RECIPIENT_PERSON_NM,XP_RECIPIENT_BUSINESS_NAME),
+        'recipient_address': ' '.join(XP_RECIPIENT_US_ADDRESS(grant)),
+        'purpose': ' '.join(XP_PURPOSE(grant)),
+        'amount': safe_int(' '.join(XP_AMT(grant)),fname,'amount')
+    }
 
-# ----------- EXPORT Functions for various formats ---------------------
 
-def export_to_csv(data_tree,year,part,zipmode="w"):
+def drop(elem):
+    
+    '''Frees a handled element along with the (already handled) siblings before it'''
+    
+    elem.clear()
+    while elem.getprevious() is not None:
+        del elem.getparent()[0]
+
+# ----------- Handlers for the elements of interest, dispatched by tag -------------
+
+def keep_header(elem,fname,header,officers,grants):
+    
+    '''Keeps the first header element of each kind for parse_return'''
+    
+    header.setdefault(elem.tag,elem)
+
+def handle_officer(elem,fname,header,officers,grants):
+    
+    '''Packages an officer group as soon as it closes'''
+    
+    officers[elem.tag].append(parse_officer(elem))
+    drop(elem)
+
+def handle_grant(elem,fname,header,officers,grants):
+    
+    '''Packages a grant group as soon as it closes'''
+    
+    grants.append(parse_grant(elem,fname))
+    drop(elem)
+
+# handlers keyed by namespace-qualified tag, so elements dispatch on elem.tag as is
+HANDLERS = {tag: keep_header for tag in HEADER_TAGS}
+HANDLERS.update({tag: handle_officer for tag in OFFICER_TAGS})
+HANDLERS.update({tag: handle_grant for tag in GRANT_TAGS})
+HANDLED_TAGS = tuple(HANDLERS)
+
+# One pull parser per process, reused for every return it parses (a closed
+# lxml feed parser is ready for the next document). libxml2 only surfaces
+# the elements that have a handler, plus ReturnData as it opens so its
+# forms/schedules can be freed once they close.
+PARSER = ET.XMLPullParser(
+    events=('start','end'), tag=HANDLED_TAGS + (TAG_RETURN_DATA,),
+    huge_tree=True, remove_blank_text=True, collect_ids=False
+)
+
+# bytes fed to the parser at a time
+CHUNK_SIZE = 64 * 1024
+
+
+def return_tree(f,fname): 
     
-    '''Exports a data tree to keyed csv files'''
+    '''Streams an XML return from a file object, packaging its data as a dictionary'''
     
-    returns = list(data_tree)
-    officers = []
+    header = {}
+    officers = {tag: [] for tag in OFFICER_TAGS}
     grants = []
-    for r in returns:
-        for o in r['officers']:
-            o['src_fname'] = r['src_fname'] 
-            officers += [o]
+    
+    return_data = []
+    
+    def handle_events():
+        for event, elem in PARSER.read_events():
+            if event == 'end':
+                handler = HANDLERS.get(elem.tag)
+                if handler:
+                    handler(elem,fname,header,officers,grants)
+            elif elem.tag == TAG_RETURN_DATA:
+                return_data.append(elem)
         
-        for g in r['grants']:
-            g['src_fname'] = r['src_fname'] 
-            grants += [g]
-            
-    # generate returns.csv
-    df = pd.DataFrame(returns)
-    del df['officers']
-    del df['grants']
-    df.to_csv("tmp/returns.csv",mode="w",index=False)
+        # every form/schedule but the last (which may still be open) has
+        # closed, and anything of interest inside has been handled
+        for sections in return_data:
+            while len(sections) > 1:
+                del sections[0]
     
-    # generate officers.csv
-    df = pd.DataFrame(officers)
-    df.to_csv("tmp/officers.csv",mode="w",index=False)
+    # one pass, handling elements as they close
+    for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+        PARSER.feed(chunk)
+        handle_events()
+    PARSER.close()
+    handle_events()
     
-    # generate grants.csv
-    df = pd.DataFrame(grants)
-    df.to_csv("tmp/grants.csv",mode="w",index=False)
+    tree = parse_return(header,fname)
+    
+    # officer groups come out grouped by tag (see OFFICER_TAGS), not in document order
+    officers = [officer for tag in OFFICER_TAGS for officer in officers[tag]]
+    
+    # officer listed in header; only use if no other records found
+    tree['officers'] = officers or parse_header_officer(header)
+    tree['grants'] = grants
     
-    # export to zipfile
-    fname = "IRS990_csv_" + str(year)+ "_part_"+ str(part) + ".zip"
-    with zipfile.ZipFile(csv_dir / fname, mode=zipmode, compression = zipfile.ZIP_DEFLATED) as outzip:
-        prefix = "IRS990_csv_" + str(year)+ "_part_"+ str(part)+"_"
-        outzip.write("tmp/returns.csv",prefix+"returns.csv")
-        outzip.write("tmp/officers.csv",prefix+"officers.csv")
-        outzip.write("tmp/grants.csv",prefix+"grants.csv")
+    # key the officers and grants to their return
+    for record in tree['officers'] + grants:
+        record['src_fname'] = fname
     
+    return tree
+
+# ----------- Worker processes: each decompresses and parses its own members ----------
 
-def export_to_json(data_tree,year,part, zipmode="w"):
+# Every worker opens its own handle on the zip being processed. A ZipFile
+# handle can't be shared, but any number of them can read the same file, so
+# the Deflate streams of the members are inflated in parallel too.
+worker_zf = None
+
+def open_zip(zf_path):
     
-    '''Exports a data tree as a json file'''
+    '''Opens the worker's own handle on a zip of XML returns'''
     
-    with open("tmp/returns.json",'w') as jf:
-        json.dump(data_tree,jf)
+    global worker_zf
+    worker_zf = zipfile.ZipFile(zf_path, 'r')
+
+# return type as it appears in the raw xml header, in either schema version
+RETURN_TYPE_RE = re.compile(rb'<ReturnType(?:Cd)?>([^<]+)</')
+# RETURN_TYPES as bytes, to compare with the regex match as-is
+RETURN_TYPE_BYTES = None if RETURN_TYPES is None else {t.encode() for t in RETURN_TYPES}
+
+def parse_member(fname):
     
-    fname = "IRS990_json_" + str(year)+ "_part_"+ str(part) + ".zip"
-    with zipfile.ZipFile(json_dir / fname, mode=zipmode, compression = zipfile.ZIP_DEFLATED) as outzip:
-        prefix = "IRS990_json_" + str(year)+ "_part_"+ str(part)+"_"
-        outzip.write("tmp/returns.json", prefix + "returns.json")
-   
+    '''Packages one XML return straight from the worker's zip handle;
+    None if it isn't one of the RETURN_TYPES'''
+    
+    # lxml's parse errors can't be pickled back to the main process, so
+    # they're passed on as a plain ValueError naming the member
+    try:
+        return parse_return_member(fname)
+    except ET.XMLSyntaxError as e:
+        # leave the shared parser clean for the next return
+        for event in PARSER.read_events():
+            pass
+        try:
+            PARSER.close()
+        except ET.XMLSyntaxError:
+            pass
+        raise ValueError('could not parse %s: %s' % (fname,e)) from None
 
-# -------------------- Main code --------------------------------
-# process each zipped xml file in the raw downloads directory
-for zf_path in sorted(list(raw_zips_dir.glob('./*.zip'))):
+def parse_return_member(fname):
     
-    # extract the year from the zf_path
-    year = zf_path.name.split("_")[1]
-    part = zf_path.name.split("_")[2].split(".")[0]
- 
-    print(zf_path, year)
+    '''Packages one XML return from the worker's zip handle (see parse_member)'''
     
-    zf = zipfile.ZipFile(zf_path, 'r')
+    if RETURN_TYPES is None:
+        with worker_zf.open(fname) as f:
+            return return_tree(f,fname)
     
-    # processes each xml document in the zip; builds up a data tree
-    data_tree = []
-    for i,fname in enumerate(zf.namelist()):
-        if (i % 1000 == 0):
-            print(i, fname)
-        
-        # extract the xml into a live ET tree
-        with zf.open(fname) as f:
-            xml_tree = ET.parse(f)
-            xml_root = xml_tree.getroot()
+    # check the return type on the raw bytes before paying for a parse
+    data = worker_zf.read(fname)
+    m = RETURN_TYPE_RE.search(data)
+    if m and m.group(1).strip() not in RETURN_TYPE_BYTES:
+        return None
+    
+    # the regex misses some (e.g. a prefixed or attributed tag); the parsed
+    # return type has the final say
+    tree = return_tree(io.BytesIO(data),fname)
+    if tree['return_type'] not in RETURN_TYPES:
+        return None
+    return tree
 
-            data_tree += [return_tree(xml_root,fname)]
+def parse_members(fnames):
+    
+    '''Packages a batch of XML returns (see parse_member)'''
     
-    # exports
-    export_to_csv(data_tree, year,part)
-    export_to_json(data_tree, year,part)
+    return [parse_member(fname) for fname in fnames]
+
+def map_bounded(executor,fn,items,chunksize,ahead):
+    
+    '''Like executor.map(fn,items,chunksize=...), with results in order, except fn
+    gets a whole chunk (list) of items and returns a list, and at most `ahead`
+    chunks are in flight at a time. The first chunks are submitted right away.'''
+    
+    chunks = (items[i:i+chunksize] for i in range(0,len(items),chunksize))
+    pending = collections.deque(executor.submit(fn,chunk) for chunk in itertools.islice(chunks,ahead))
+    
+    def results():
+        while pending:
+            batch = pending.popleft().result()
+            for chunk in itertools.islice(chunks,1):
+                pending.append(executor.submit(fn,chunk))
+            yield from batch
+    
+    return results()
+
+# ----------- EXPORT Functions for various formats ---------------------
+
+# pick a record's csv columns out of its dictionary as a tuple, in column order
+# (itemgetter does it in C, where DictWriter runs a Python generator per row)
+return_row = itemgetter(*RETURN_COLS)
+officer_row = itemgetter(*OFFICER_COLS)
+grant_row = itemgetter(*GRANT_COLS)
+
+def csv_writer(f,cols):
+    
+    '''Makes a csv writer for rows of the given columns; writes the header'''
+    
+    w = csv.writer(f,lineterminator='\n')
+    w.writerow(cols)
+    return w
+
+def open_member(outzip,name):
+    
+    '''Opens a new member of a zipfile for streaming writes, stamped with the current
+    time and readable by all (rw-r--r--, as the files zipped with outzip.write were)'''
+    
+    zinfo = zipfile.ZipInfo(name,time.localtime()[:6])
+    zinfo.compress_type = outzip.compression
+    zinfo.external_attr = 0o644 << 16
+    
+    # the size isn't known up front, so allow for a large one
+    return outzip.open(zinfo,'w',force_zip64=True)
+
+@contextmanager
+def open_exports(year,part,zipmode="w"):
+    
+    '''Opens the csv and json exports of a part, yielding a function that writes
+    one return tree to all of them as it arrives; the rows are compressed on
+    the fly, straight into the zipfiles'''
+    
+    csv_fname = "IRS990_csv_" + str(year)+ "_part_"+ str(part) + ".zip"
+    csv_prefix = "IRS990_csv_" + str(year)+ "_part_"+ str(part)+"_"
+    json_fname = "IRS990_json_" + str(year)+ "_part_"+ str(part) + ".zip"
+    json_prefix = "IRS990_json_" + str(year)+ "_part_"+ str(part)+"_"
+    
+    # written under a temporary name and moved into place only once complete,
+    # so a failed run never leaves a truncated zip behind
+    paths = (csv_dir / csv_fname, json_dir / json_fname)
+    partial = [path.with_name(path.name + ".partial") for path in paths]
+    if "a" in zipmode:
+        for path,tmp in zip(paths,partial):
+            if path.exists():
+                shutil.copyfile(path,tmp)
+    
+    try:
+        with zipfile.ZipFile(partial[0], mode=zipmode, compression = ZIP_COMPRESSION) as csv_zip, \
+             zipfile.ZipFile(partial[1], mode=zipmode, compression = ZIP_COMPRESSION) as json_zip, \
+             tempfile.SpooledTemporaryFile(SPOOL_SIZE,mode='w+',newline='',encoding='utf-8') as of, \
+             tempfile.SpooledTemporaryFile(SPOOL_SIZE,mode='w+',newline='',encoding='utf-8') as gf:
+            
+            with io.TextIOWrapper(open_member(csv_zip,csv_prefix+"returns.csv"),newline='',encoding='utf-8') as rf, \
+                 open_member(json_zip,json_prefix+"returns.json") as jf:
+                
+                # returns.csv leaves out the nested officers and grants (see RETURN_COLS)
+                returns_w = csv_writer(rf,RETURN_COLS)
+                officers_w = csv_writer(of,OFFICER_COLS)
+                grants_w = csv_writer(gf,GRANT_COLS)
+                
+                # returns.json is a single array of return trees
+                jf.write(b'[')
+                sep = b''
+                
+                def export(tree):
+                    nonlocal sep
+                    returns_w.writerow(return_row(tree))
+                    officers_w.writerows(map(officer_row,tree['officers']))
+                    grants_w.writerows(map(grant_row,tree['grants']))
+                    jf.write(sep)
+                    jf.write(orjson.dumps(tree))
+                    sep = b',\n'
+                
+                yield export
+                
+                jf.write(b']')
+            
+            # a zipfile takes one member at a time, so officers and grants
+            # are held in memory (or a temp file, if large) until returns.csv is done
+            for buf,name in ((of,"officers.csv"),(gf,"grants.csv")):
+                buf.seek(0)
+                with io.TextIOWrapper(open_member(csv_zip,csv_prefix+name),newline='',encoding='utf-8') as zf:
+                    shutil.copyfileobj(buf,zf)
+    except BaseException:
+        for tmp in partial:
+            tmp.unlink(missing_ok=True)
+        raise
+    
+    for tmp,path in zip(partial,paths):
+        os.replace(tmp,path)
+
+# marks the end of the trees queued for export
+SENTINEL = object()
+
+@contextmanager
+def in_background(export,maxsize=1024):
+    
+    '''Runs an export function on its own thread, fed through a bounded queue, so
+    writing (and compressing) the output overlaps with parsing; yields the
+    function that queues a tree for it'''
+    
+    q = queue.Queue(maxsize)
+    errors = []
+    
+    def writer():
+        try:
+            while (tree := q.get()) is not SENTINEL:
+                export(tree)
+        except BaseException as e:
+            errors.append(e)
+            # keep draining so nothing blocks on a full queue
+            while q.get() is not SENTINEL:
+                pass
+    
+    def put(tree):
+        # stop feeding a writer that has already failed
+        if errors:
+            raise errors[0]
+        q.put(tree)
+    
+    t = threading.Thread(target=writer)
+    t.start()
+    try:
+        yield put
+    finally:
+        q.put(SENTINEL)
+        t.join()
+    
+    if errors:
+        raise errors[0]
+   
+
+# -------------------- Main code --------------------------------
+# process each zipped xml file in the raw downloads directory
+if __name__ == '__main__':
+    now = datetime.datetime.now()
+    logging.info(f"Run started {now}")
+    for zf_path in sorted(list(raw_zips_dir.glob('./*.zip'))):
+        
+        # extract the year from the zf_path
+        year = zf_path.name.split("_")[1]
+        part = zf_path.name.split("_")[2].split(".")[0]
+     
+        print(f"{zf_path} {year}")
+        logging.info(f"{zf_path} {year}")
+        
+        with zipfile.ZipFile(zf_path, 'r') as zf:
+            fnames = zf.namelist()
+        
+        # unzips and parses the xml documents across all cores;
+        # each return tree is handed to the export thread as soon as it arrives
+        with ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=open_zip, initargs=(zf_path,)) as executor:
+            # Executor.map would queue every member up front; only keep a few
+            # chunks per core in flight, so finished trees can't pile up either.
+            # The first chunks go out (forking the workers) before the export
+            # thread starts, so no thread is running when the pool forks.
+            trees = map_bounded(executor, parse_members, fnames, 64, 4 * os.cpu_count())
+            
+            with open_exports(year,part) as write_tree, \
+                 in_background(write_tree) as export:
+                for i,tree in enumerate(trees):
+                    if (i % 1000 == 0):
+                        print(f"{i} {fnames[i]}")
+                        logging.info(f"{i} {fnames[i]}")
+                    
+                    # skipped by return type
+                    if tree is None:
+                        continue
+                    
+                    export(tree)
       
     
         
@@ -281,15 +670,12 @@ for zf_path in sorted(list(raw_zips_dir.glob('./*.zip'))):
         
         
 
-
 # In[ ]:
 
 
 
 
-
 # In[ ]:
 
 
 
-